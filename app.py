@@ -1,34 +1,141 @@
+import asyncio
+import atexit
+import hashlib
+import logging
 import os
+import queue
 import secrets
+import weakref
+from contextlib import asynccontextmanager
 from datetime import timedelta
-from typing import Dict, Any
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from typing import AsyncIterator, Dict, Any
 
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from openai import AzureOpenAI
+import httpx
+import openai
+import orjson
+import tiktoken
+from cachetools import TTLCache
+from openai import AsyncAzureOpenAI
+from quart import Quart, Response, request, jsonify
+from quart.json.provider import JSONProvider
+from quart_cors import cors
+from redis.asyncio import ConnectionPool, Redis
+from redis.exceptions import LockError, RedisError, WatchError
+from tenacity import RetryCallState, retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 # ------------------------------------------------------------------------------
-# Flask setup
+# Logging (request paths only enqueue; a listener thread does the writing)
 # ------------------------------------------------------------------------------
-app = Flask(__name__)
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, which App Service log streams and App Insights ingest as-is.
+    Pass structured context with extra={"fields": {...}}."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=repr).decode()
+
+log_queue: queue.Queue = queue.Queue(-1)
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(JsonFormatter())
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger = logging.getLogger("daiol_chatbot")
+logger.setLevel(logging.INFO)
+logger.addHandler(queue_handler)
+logger.propagate = False
+
+# ------------------------------------------------------------------------------
+# Quart setup (ASGI, so slow model calls don't block other requests)
+# ------------------------------------------------------------------------------
+class OrjsonProvider(JSONProvider):
+    """Parse request bodies and build jsonify() responses with orjson."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
 # In production, set this to the exact origin of your Static Web App
-CORS(app, resources={r"/api/*": {"origins": "*"}})
+app = cors(app, allow_origin="*")
 
 app.config["JSON_SORT_KEYS"] = False
 app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(hours=12)
 
 # ------------------------------------------------------------------------------
-# Session store (replace with Redis/Azure Cache for Redis in production)
+# Session store (Redis / Azure Cache for Redis, shared by all workers)
 # ------------------------------------------------------------------------------
-# Structure:
-# user_sessions[token] = {
-#   "messages": [{"role": "...", "content": "..."}],
+# Structure, as two keys per token that expire after PERMANENT_SESSION_LIFETIME
+# without activity. The history is an append-only list, so a turn writes only
+# its own messages instead of re-serializing the whole transcript:
+# msgs:{token} -> LIST of orjson {"role": "...", "content": "...", "_tok": <token count>}
+# meta:{token} -> HASH of orjson-encoded fields:
+# {
 #   "meta": {"userName": "...", "cohortId": "...", "systemPrompt": "...", "initialMessage": "..."},
 #   "model": "deployment-name",
 #   "default_temperature": 1.0,
 #   "default_max_completion_tokens": 512,
+#   "summary": "...",          # running summary of turns no longer sent verbatim
+#   "summarized_upto": 0,      # how many messages after the system prompt it covers
+#   "version": 0,              # bumped by every write, so worker caches can tell they're stale
 # }
-user_sessions: Dict[str, Dict[str, Any]] = {}
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+SESSION_TTL_SECONDS = int(app.config["PERMANENT_SESSION_LIFETIME"].total_seconds())
+
+redis_client: Redis | None = None
+
+@app.before_serving
+async def create_redis_client() -> None:
+    global redis_client
+    redis_client = Redis(connection_pool=ConnectionPool.from_url(REDIS_URL, max_connections=50))
+
+@app.after_serving
+async def close_redis_client() -> None:
+    if redis_client is not None:
+        await redis_client.aclose()
+
+# One lock per token (held only while a request uses it) so overlapping turns
+# for the same session on this worker don't interleave across an await. The
+# Redis lock in turn_lock() does the same across workers. Its TTL only matters
+# if a worker dies mid-turn: while a turn runs it is renewed every third of
+# TURN_LOCK_SECONDS, however long retries or a stream take.
+TURN_LOCK_SECONDS = 30
+TURN_WAIT_SECONDS = 120  # how long a turn queues behind a busy session before a 409
+session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# Per-worker read cache in front of Redis: consecutive turns from a learner that
+# land on the same worker skip reloading the history. Any worker may have written
+# since, so every read first checks the cached copy's version against Redis.
+local_sessions: TTLCache = TTLCache(
+    maxsize=10_000,
+    ttl=int(os.environ.get("LOCAL_SESSION_TTL_SECONDS", "300")),
+)
+
+# Tokens with a history fold in flight on this worker, so turns that overflow
+# meanwhile don't each pay for a summary that save_summary() would discard
+folding_sessions: set[str] = set()
+# Tokens whose last fold failed or came back empty, held off for FOLD_RETRY_SECONDS
+# rather than paying for another summary call on every over-budget turn
+FOLD_RETRY_SECONDS = 300
+fold_cooldowns: TTLCache = TTLCache(maxsize=10_000, ttl=FOLD_RETRY_SECONDS)
 
 # ------------------------------------------------------------------------------
 # Defaults
@@ -42,13 +149,145 @@ BASE_SYSTEM_PROMPT = (
     "Answer with concrete examples drawn from business cases. The audience is professionals, leaders and strategists "
     "leveraging AI to improve their organizations."
 )
+# Recent turns are sent verbatim up to HISTORY_TOKEN_BUDGET; older ones are
+# folded into a running summary so per-turn prompt size stays bounded instead
+# of growing with the conversation. CONTEXT_TOKEN_LIMIT is the hard cap on
+# prompt + completion if a fold hasn't caught up yet.
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "4000"))
+CONTEXT_TOKEN_LIMIT = int(os.environ.get("CONTEXT_TOKEN_LIMIT", "128000"))
+MAX_COMPLETION_TOKENS = CONTEXT_TOKEN_LIMIT // 2  # per-request cap, so the prompt keeps room for history
+# tiktoken downloads the encoding on a cold cache (set TIKTOKEN_CACHE_DIR to one
+# filled at build time to avoid that), so it's loaded in the background after
+# startup rather than at import; token counts are estimated until it's there.
+token_encoding: tiktoken.Encoding | None = None
+
+async def load_token_encoding() -> None:
+    global token_encoding
+    try:
+        token_encoding = await asyncio.to_thread(tiktoken.encoding_for_model, "gpt-4o-mini")
+    except Exception:
+        logger.warning("tiktoken encoding unavailable, estimating token counts", exc_info=True)
+
+@app.before_serving
+async def schedule_token_encoding() -> None:
+    app.add_background_task(load_token_encoding)
+
+SUMMARY_PROMPT = (
+    "Summarize the prior turns of this conversation between a learner and their course copilot in at most "
+    "200 tokens. Keep names, goals, decisions, open questions and anything the learner asked to remember."
+)
+# Reasoning models count their reasoning against this too, so leave headroom over 200
+SUMMARY_MAX_COMPLETION_TOKENS = 1024
+# "minimal" or "low" on reasoning deployments (gpt-5*, o-series) keeps the summary from
+# spending its budget thinking; leave empty for models that reject it (gpt-4o*)
+SUMMARY_REASONING_EFFORT = os.environ.get("SUMMARY_REASONING_EFFORT", "")
+
+# Near-deterministic requests (temperature <= RESPONSE_CACHE_MAX_TEMPERATURE) are
+# answered from Redis when the same prompt, model and recent tail were seen
+# recently -- learners in a cohort often ask the same FAQ-style questions.
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.environ.get("RESPONSE_CACHE_MAX_TEMPERATURE", "0.1"))
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_TAIL = 4  # last 2 user + 2 assistant turns
+
+EMPTY_RESPONSE_TEXT = "Sorry, I didn't receive a response from the model. Please try again."
+ERROR_RESPONSE_TEXT = "Sorry, I encountered an error."
+SESSION_BUSY_TEXT = "Another message for this session is still being processed."
+
+# ------------------------------------------------------------------------------
+# Azure OpenAI client
+# ------------------------------------------------------------------------------
+# Built once per worker at startup and shared across requests so the underlying
+# connection pool (TCP + TLS) is reused via keep-alive instead of re-handshaking
+# every turn. Created inside the serving event loop, not at import.
+client: AsyncAzureOpenAI | None = None
+
+@app.before_serving
+async def create_azure_client() -> None:
+    global client
+    client = AsyncAzureOpenAI(
+        api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
+        api_version=os.environ.get("AZURE_OPENAI_API_VERSION", "2024-10-21"),
+        azure_endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT"),
+        max_retries=0,  # retries are handled by azure_retry
+        # HTTP/2 multiplexes concurrent completions over one TCP+TLS connection.
+        # The limits still apply if Azure negotiates HTTP/1.1 instead.
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=60.0,
+        ),
+    )
+
+@app.after_serving
+async def close_azure_client() -> None:
+    if client is not None:
+        await client.close()
+
+async def warm_connections() -> None:
+    """Open the Azure (DNS + TCP + TLS) and Redis connections before the first
+    learner's request would have to. Failures only mean a cold first request."""
+    try:
+        await list_azure_models()
+    except Exception:
+        logger.warning("Azure warm-up failed", exc_info=True)
+    try:
+        await redis_client.ping()
+    except Exception:
+        logger.warning("Redis warm-up failed", exc_info=True)
+
+@app.before_serving
+async def schedule_warm_up() -> None:
+    # Runs in each worker after fork, so every worker warms its own pools,
+    # and in the background so startup isn't held up by it
+    app.add_background_task(warm_connections)
+
+# Transient Azure errors are retried with jittered exponential backoff, honoring
+# Retry-After when Azure sends one. Same cases the SDK's own retries covered:
+# connection failures and timeouts (incl. a pooled connection reset or sent an
+# HTTP/2 GOAWAY), 408, 409, 429 under burst load and 5xx.
+RETRYABLE_AZURE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+RETRYABLE_AZURE_STATUSES = (408, 409)
+backoff = wait_random_exponential(min=1, max=20)
+
+def is_retryable_azure_error(error: BaseException) -> bool:
+    if isinstance(error, RETRYABLE_AZURE_ERRORS):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in RETRYABLE_AZURE_STATUSES
+
+def wait_for_azure(retry_state: RetryCallState) -> float:
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    if response is not None:
+        try:
+            if "retry-after-ms" in response.headers:
+                return min(float(response.headers["retry-after-ms"]) / 1000, 20)
+            if "retry-after" in response.headers:
+                return min(float(response.headers["retry-after"]), 20)
+        except ValueError:
+            pass
+    return backoff(retry_state)
+
+azure_retry = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_for_azure,
+    retry=retry_if_exception(is_retryable_azure_error),
+    reraise=True,
+)
+
+@azure_retry
+async def call_azure(**kwargs: Any) -> Any:
+    return await client.chat.completions.create(**kwargs)
+
+@azure_retry
+async def list_azure_models() -> Any:
+    return await client.models.list()
 
 # ------------------------------------------------------------------------------
 # Helpers
 # ------------------------------------------------------------------------------
 def generate_session_token() -> str:
-    return secrets.token_hex(32)  # 64-char hex
+    return secrets.token_urlsafe(32)  # 43-char base64url, same 256 bits
 
+@lru_cache(maxsize=10_000)  # a client resends the same header every turn; bounded against junk headers
 def extract_token(auth_header: str | None) -> str | None:
     """Accepts either raw token or 'Bearer <token>' for compatibility."""
     if not auth_header:
@@ -60,13 +299,6 @@ def extract_token(auth_header: str | None) -> str | None:
         return parts[1]
     return None
 
-def get_azure_client() -> AzureOpenAI:
-    return AzureOpenAI(
-        api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
-        api_version=os.environ.get("AZURE_OPENAI_API_VERSION", "2024-10-21"),
-        azure_endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT"),
-    )
-
 def build_system_prompt(system_prompt_from_client: str | None, meta: Dict[str, Any]) -> str:
     """Use the provided system prompt if present, otherwise the base prompt.
     Optionally enrich with meta so the assistant can personalize output."""
@@ -82,15 +314,403 @@ def build_system_prompt(system_prompt_from_client: str | None, meta: Dict[str, A
         base = base.rstrip() + "\n\n" + "\n".join(extras)
     return base
 
+def meta_key(token: str) -> str:
+    return f"meta:{token}"
+
+def messages_key(token: str) -> str:
+    return f"msgs:{token}"
+
+def session_lock(token: str) -> asyncio.Lock:
+    lock = session_locks.get(token)
+    if lock is None:
+        lock = session_locks[token] = asyncio.Lock()
+    return lock
+
+@asynccontextmanager
+async def turn_lock(token: str) -> AsyncIterator[None]:
+    """Serialize a session's turns everywhere: waiters on this worker queue on the
+    asyncio.Lock, other workers on a Redis SET NX PX lock released by compare-and-delete.
+    Raises LockError if the session stays busy for TURN_WAIT_SECONDS, counted across both."""
+    local_lock = session_lock(token)
+    deadline = asyncio.get_running_loop().time() + TURN_WAIT_SECONDS
+    try:
+        async with asyncio.timeout_at(deadline):
+            await local_lock.acquire()
+    except TimeoutError:
+        raise LockError("Session is busy") from None
+    try:
+        lock = redis_client.lock(
+            f"lock:{token}",
+            timeout=TURN_LOCK_SECONDS,
+            sleep=0.05,
+            blocking_timeout=max(deadline - asyncio.get_running_loop().time(), 0),
+        )
+        if not await lock.acquire():
+            raise LockError("Session is busy")
+        renewal = asyncio.ensure_future(renew_turn_lock(lock))
+        try:
+            yield
+        finally:
+            renewal.cancel()
+            await asyncio.wait([renewal])
+            try:
+                await lock.release()
+            except LockError:
+                logger.warning("Turn lock expired mid-turn")
+            except RedisError:
+                # The turn itself is done; the lock lapses after TURN_LOCK_SECONDS
+                logger.exception("Session store error")
+    finally:
+        local_lock.release()
+
+async def renew_turn_lock(lock: Any) -> None:
+    """Background task: keep pushing out the Redis lock's expiry while its turn runs."""
+    while True:
+        await asyncio.sleep(TURN_LOCK_SECONDS / 3)
+        try:
+            await lock.reacquire()
+        except LockError:
+            logger.warning("Turn lock expired mid-turn")
+            return
+        except Exception:
+            logger.exception("Session store error")
+
+async def load_session(token: str) -> Dict[str, Any] | None:
+    """Fields and history in a single round trip, refreshing both TTLs."""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(meta_key(token))
+        pipe.lrange(messages_key(token), 0, -1)
+        pipe.expire(meta_key(token), SESSION_TTL_SECONDS)
+        pipe.expire(messages_key(token), SESSION_TTL_SECONDS)
+        fields, messages, _, _ = await pipe.execute()
+    if not fields:
+        return None
+    session = {name.decode(): orjson.loads(value) for name, value in fields.items()}
+    session.setdefault("version", 0)
+    session["messages"] = [orjson.loads(m) for m in messages]
+    return session
+
+async def create_session(token: str, session: Dict[str, Any]) -> None:
+    fields = {name: orjson.dumps(value) for name, value in session.items() if name != "messages"}
+    fields["version"] = orjson.dumps(0)
+    async with redis_client.pipeline() as pipe:
+        pipe.hset(meta_key(token), mapping=fields)
+        pipe.rpush(messages_key(token), *(orjson.dumps(m) for m in session["messages"]))
+        pipe.expire(meta_key(token), SESSION_TTL_SECONDS)
+        pipe.expire(messages_key(token), SESSION_TTL_SECONDS)
+        await pipe.execute()
+
+async def append_messages(token: str, messages: list[Dict[str, Any]]) -> int:
+    """Append to history and return the session's new version."""
+    async with redis_client.pipeline() as pipe:
+        pipe.rpush(messages_key(token), *(orjson.dumps(m) for m in messages))
+        pipe.hincrby(meta_key(token), "version", 1)
+        pipe.expire(meta_key(token), SESSION_TTL_SECONDS)
+        pipe.expire(messages_key(token), SESSION_TTL_SECONDS)
+        _, version, _, _ = await pipe.execute()
+    return version
+
+async def reset_messages(token: str) -> bool:
+    """Trim history back to the system prompt composed at /api/start (already
+    stored, with its token count). False if the session is gone."""
+    # Checked first so a reset with a stale token doesn't recreate meta via HINCRBY
+    if not await redis_client.exists(meta_key(token)):
+        return False
+    async with redis_client.pipeline() as pipe:
+        pipe.ltrim(messages_key(token), 0, 0)
+        pipe.hdel(meta_key(token), "summary", "summarized_upto")
+        pipe.hincrby(meta_key(token), "version", 1)
+        pipe.expire(meta_key(token), SESSION_TTL_SECONDS)
+        pipe.expire(messages_key(token), SESSION_TTL_SECONDS)
+        await pipe.execute()
+    return True
+
+async def get_session(token: str) -> Dict[str, Any] | None:
+    """The locally cached session if Redis still has the same version (one HGET),
+    otherwise a fresh load. Turns, folds and resets on any worker bump the version."""
+    session = local_sessions.get(token)
+    if session is not None:
+        version = await redis_client.hget(meta_key(token), "version")
+        if version is not None and orjson.loads(version) == session["version"]:
+            return session
+    session = await load_session(token)
+    if session is None:
+        local_sessions.pop(token, None)
+    else:
+        local_sessions[token] = session
+    return session
+
+async def save_summary(token: str, upto: int, folded: int, summary: str) -> int | None:
+    """Record a history fold unless a reset or another fold changed things meanwhile.
+    Returns the session's new version, or None if the fold was discarded."""
+    async with redis_client.pipeline() as pipe:
+        try:
+            await pipe.watch(meta_key(token))
+            current = await pipe.hget(meta_key(token), "summarized_upto")
+            length = await pipe.llen(messages_key(token))
+            if orjson.loads(current or b"0") != upto or length <= 1 + upto + folded:
+                return None
+            pipe.multi()
+            pipe.hset(meta_key(token), mapping={
+                "summary": orjson.dumps(summary),
+                "summarized_upto": orjson.dumps(upto + folded),
+            })
+            pipe.hincrby(meta_key(token), "version", 1)
+            _, version = await pipe.execute()
+        except WatchError:
+            return None  # the next overflow folds again
+    return version
+
+def count_tokens(text: str) -> int:
+    if token_encoding is None:
+        return len(text) // 4  # rough English average until the encoding has loaded
+    return len(token_encoding.encode(text))
+
+def chat_message(role: str, content: str) -> Dict[str, Any]:
+    """A history entry carrying its token count, so budgets never re-tokenize it."""
+    return {"role": role, "content": content, "_tok": count_tokens(content)}
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    tokens = message.get("_tok")
+    return tokens if tokens is not None else count_tokens(message["content"])
+
+def unsummarized_history(session: Dict[str, Any]) -> list[Dict[str, Any]]:
+    return session["messages"][1 + session.get("summarized_upto", 0):]
+
+def user_turn_messages(user_message: str, per_request_context: str | None) -> list[Dict[str, Any]]:
+    messages = []
+    # Inject transient context if provided (doesn't persist across turns)
+    if per_request_context:
+        messages.append(chat_message("system", f"Context for this turn: {per_request_context}"))
+
+    # Append user message
+    messages.append(chat_message("user", user_message))
+    return messages
+
+def completion_params(data: Dict[str, Any], session: Dict[str, Any]) -> tuple[float, int] | None:
+    """temperature and max_completion_tokens from a chat body (else the session defaults),
+    or None unless they're a temperature in [0, 2] and a whole number of tokens in
+    [1, MAX_COMPLETION_TOKENS]."""
+    temperature = data.get("temperature", session["default_temperature"])
+    max_completion_tokens = data.get("max_completion_tokens", session["default_max_completion_tokens"])
+    if isinstance(temperature, bool) or isinstance(max_completion_tokens, bool):
+        return None
+    if isinstance(max_completion_tokens, float) and not max_completion_tokens.is_integer():
+        return None
+    try:
+        temperature = float(temperature)
+        max_completion_tokens = int(max_completion_tokens)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if not 0 <= temperature <= 2 or not 1 <= max_completion_tokens <= MAX_COMPLETION_TOKENS:
+        return None
+    return temperature, max_completion_tokens
+
+def model_messages(
+    session: Dict[str, Any],
+    pending: list[Dict[str, Any]],
+    max_completion_tokens: int,
+) -> list[Dict[str, str]]:
+    """System prompt, running summary (if any), as much unsummarized history as fits
+    in CONTEXT_TOKEN_LIMIT alongside the completion budget, then this turn."""
+    head = session["messages"][:1]
+    if session.get("summary"):
+        head.append(chat_message("system", f"Summary of the earlier conversation: {session['summary']}"))
+
+    history = unsummarized_history(session)
+    budget = CONTEXT_TOKEN_LIMIT - max_completion_tokens - sum(map(message_tokens, head + pending))
+    start = len(history)
+    while start > 0 and message_tokens(history[start - 1]) <= budget:
+        start -= 1
+        budget -= message_tokens(history[start])
+
+    # Azure only gets role/content; _tok stays server-side
+    return [{"role": m["role"], "content": m["content"]} for m in head + history[start:] + pending]
+
+def response_cache_key(
+    model: str,
+    messages: list[Dict[str, str]],
+    temperature: float,
+    max_completion_tokens: int,
+) -> str | None:
+    """Redis key for this request's reply, or None if sampling is too random to reuse."""
+    if temperature > RESPONSE_CACHE_MAX_TEMPERATURE:
+        return None
+    digest = hashlib.blake2b(orjson.dumps([
+        model,
+        messages[0]["content"],  # system prompt
+        messages[-RESPONSE_CACHE_TAIL:],
+        temperature,
+        max_completion_tokens,
+    ])).hexdigest()
+    return f"resp:{digest}"
+
+async def cache_response(key: str, response_text: str) -> None:
+    try:
+        await redis_client.set(key, response_text, ex=RESPONSE_CACHE_TTL_SECONDS)
+    except Exception:
+        logger.exception("Response cache error")
+
+async def fold_history(token: str) -> None:
+    """Background task: once unsummarized history exceeds HISTORY_TOKEN_BUDGET, fold
+    the oldest messages into the running summary, keeping about half the budget."""
+    try:
+        await summarize_history(token)
+    except Exception:
+        logger.exception("History summary error")
+        fold_cooldowns[token] = True
+    finally:
+        folding_sessions.discard(token)
+
+async def summarize_history(token: str) -> None:
+    session = await get_session(token)
+    if session is None:
+        return
+    upto = session.get("summarized_upto", 0)
+    history = unsummarized_history(session)
+    if sum(map(message_tokens, history)) <= HISTORY_TOKEN_BUDGET:
+        return
+    split, kept = len(history), 0
+    while split > 0 and kept + message_tokens(history[split - 1]) <= HISTORY_TOKEN_BUDGET // 2:
+        split -= 1
+        kept += message_tokens(history[split])
+    folded = history[:split]
+
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in folded)
+    if session.get("summary"):
+        transcript = f"Summary so far: {session['summary']}\n\n{transcript}"
+    completion = await call_azure(
+        model=session["model"],
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ],
+        max_completion_tokens=SUMMARY_MAX_COMPLETION_TOKENS,
+        extra_body={"reasoning_effort": SUMMARY_REASONING_EFFORT} if SUMMARY_REASONING_EFFORT else None,
+    )
+    choice = completion.choices[0] if completion.choices else None
+    summary = (choice.message.content or "").strip() if choice else ""
+    if not summary:
+        logger.warning("Empty history summary", extra={"fields": {
+            "finish_reason": getattr(choice, "finish_reason", None),
+            "usage": getattr(completion, "usage", None),
+            "model": session.get("model"),
+        }})
+        fold_cooldowns[token] = True
+        return
+
+    version = await save_summary(token, upto, len(folded), summary)
+    if version is None:
+        return
+    cached = local_sessions.get(token)
+    if cached is not None and cached["version"] == version - 1:
+        cached["summary"] = summary
+        cached["summarized_upto"] = upto + len(folded)
+        cached["version"] = version
+
+async def record_turn(token: str, session: Dict[str, Any], pending: list[Dict[str, Any]]) -> None:
+    """Persist this turn's messages and schedule a history fold if the window overflowed."""
+    version = await append_messages(token, pending)
+    session["messages"].extend(pending)
+    if version == session["version"] + 1:
+        session["version"] = version
+        local_sessions[token] = session
+    else:
+        local_sessions.pop(token, None)  # something else wrote meanwhile; reload next read
+    if token in folding_sessions or token in fold_cooldowns:
+        return
+    if sum(map(message_tokens, unsummarized_history(session))) > HISTORY_TOKEN_BUDGET:
+        folding_sessions.add(token)
+        app.add_background_task(fold_history, token)
+
+def sse_event(payload: Any) -> str:
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+async def stream_chat(
+    token: str,
+    user_message: str,
+    per_request_context: str | None,
+    temperature: float,
+    max_completion_tokens: int,
+):
+    """Yields the reply as Server-Sent Events: {"delta": "..."} per chunk, then [DONE].
+    History is only updated with the full reply once the stream has closed."""
+    try:
+        async with turn_lock(token):
+            session = await get_session(token)
+            if session is None:
+                yield sse_event({"error": "Invalid session token"})
+                return
+            pending = user_turn_messages(user_message, per_request_context)
+            messages = model_messages(session, pending, max_completion_tokens)
+            cache_key = response_cache_key(session["model"], messages, temperature, max_completion_tokens)
+
+            parts = []
+            finish_reason = None
+            cached = None
+            try:
+                cached = await redis_client.get(cache_key) if cache_key else None
+                if cached is not None:
+                    parts.append(cached.decode())
+                    yield sse_event({"delta": parts[0]})
+                else:
+                    stream = await call_azure(
+                        model=session["model"],
+                        messages=messages,
+                        temperature=temperature,
+                        max_completion_tokens=max_completion_tokens,
+                        stream=True,
+                    )
+                    async for chunk in stream:
+                        # Azure sends a leading chunk with only content-filter results
+                        if not chunk.choices:
+                            continue
+                        choice = chunk.choices[0]
+                        finish_reason = choice.finish_reason or finish_reason
+                        delta = choice.delta.content if choice.delta else None
+                        if delta:
+                            parts.append(delta)
+                            yield sse_event({"delta": delta})
+            except Exception:
+                logger.exception("Azure OpenAI error")
+                yield sse_event({"error": ERROR_RESPONSE_TEXT})
+                return
+
+            response_text = "".join(parts)
+            if not response_text.strip():
+                logger.warning("Empty model response", extra={"fields": {
+                    "finish_reason": finish_reason,
+                    "model": session.get("model"),
+                    "stream": True,
+                }})
+                response_text = EMPTY_RESPONSE_TEXT
+                yield sse_event({"delta": response_text})
+            elif cache_key and cached is None:
+                await cache_response(cache_key, response_text)
+
+            pending.append(chat_message("assistant", response_text))
+            try:
+                await record_turn(token, session, pending)
+            except Exception:
+                logger.exception("Session store error")
+                yield sse_event({"error": ERROR_RESPONSE_TEXT})
+                return
+            yield "data: [DONE]\n\n"
+    except LockError:
+        yield sse_event({"error": SESSION_BUSY_TEXT})
+    except RedisError:
+        logger.exception("Session store error")
+        yield sse_event({"error": ERROR_RESPONSE_TEXT})
+
 # ------------------------------------------------------------------------------
 # Routes
 # ------------------------------------------------------------------------------
 @app.route("/api/health", methods=["GET"])
-def health():
+async def health():
     return jsonify({"ok": True})
 
 @app.route("/api/start", methods=["POST", "GET"])
-def start_session():
+async def start_session():
     """
     Accepts:
       - userName        (str)
@@ -102,7 +722,7 @@ def start_session():
     Returns: { token, initialMessage }
     """
     if request.method == "POST" and request.is_json:
-        payload = request.get_json(silent=True) or {}
+        payload = await request.get_json(silent=True) or {}
     else:
         # GET fallback for simple integrations
         payload = {
@@ -131,104 +751,142 @@ def start_session():
 
     # Create a new session
     token = generate_session_token()
-    user_sessions[token] = {
-        "messages": [{"role": "system", "content": system_prompt}],
-        "meta": meta,
-        "model": os.environ.get("AZURE_OPENAI_DEPLOYMENT", "gpt-5-mini"),
-        "default_temperature": float(os.environ.get("DEFAULT_TEMPERATURE", "1.0")),
-        "default_max_completion_tokens": int(os.environ.get("DEFAULT_MAX_COMPLETION_TOKENS", "2048")),
-    }
+    try:
+        await create_session(token, {
+            "messages": [chat_message("system", system_prompt)],
+            "meta": meta,
+            "model": os.environ.get("AZURE_OPENAI_DEPLOYMENT", "gpt-5-mini"),
+            "default_temperature": float(os.environ.get("DEFAULT_TEMPERATURE", "1.0")),
+            "default_max_completion_tokens": int(os.environ.get("DEFAULT_MAX_COMPLETION_TOKENS", "2048")),
+        })
+    except RedisError:
+        logger.exception("Session store error")
+        return jsonify({"error": ERROR_RESPONSE_TEXT}), 500
 
     # Return token and initial message (frontend renders welcome without burning tokens)
     return jsonify({"token": token, "initialMessage": initial_message})
 
 @app.route("/api/chat", methods=["POST"])
-def chat():
+async def chat():
     """
     Body JSON:
       - message        (required)
             - temperature    (optional float, gpt-5 defaults to 1.0)
         - max_completion_tokens (optional int)
       - context        (optional str) -> transient, injected as a one-off system note
+      - stream         (optional bool) -> reply as text/event-stream, see stream_chat()
     Header:
       - Authorization: <token> OR Authorization: Bearer <token>
     """
     token = extract_token(request.headers.get("Authorization"))
-    if not token or token not in user_sessions:
+    try:
+        session = await get_session(token) if token else None
+    except RedisError:
+        logger.exception("Session store error")
+        return jsonify({"error": ERROR_RESPONSE_TEXT}), 500
+    if session is None:
         return jsonify({"error": "Invalid session token"}), 401
 
     if not request.is_json:
         return jsonify({"error": "Expected JSON body"}), 400
 
-    data = request.get_json(silent=True) or {}
+    data = await request.get_json(silent=True) or {}
     user_message = data.get("message")
     if not user_message or not isinstance(user_message, str):
         return jsonify({"error": "Missing 'message'"}), 400
 
-    temperature = data.get("temperature", user_sessions[token]["default_temperature"])
-    max_completion_tokens = data.get(
-        "max_completion_tokens",
-        user_sessions[token]["default_max_completion_tokens"],
-    )
+    # Checked here: everything downstream (prompt budget, cache key, Azure) relies on
+    # real numbers, and a stream has already sent its 200 by then
+    params = completion_params(data, session)
+    if params is None:
+        return jsonify({"error": "Invalid 'temperature' or 'max_completion_tokens'"}), 400
+    temperature, max_completion_tokens = params
     per_request_context = data.get("context")
 
-    session = user_sessions[token]
-
-    # Inject transient context if provided (doesn't persist across turns)
-    if per_request_context:
-        session["messages"].append({
-            "role": "system",
-            "content": f"Context for this turn: {per_request_context}"
-        })
-
-    # Append user message
-    session["messages"].append({"role": "user", "content": user_message})
+    if data.get("stream"):
+        response = Response(
+            stream_chat(token, user_message, per_request_context, temperature, max_completion_tokens),
+            mimetype="text/event-stream",
+            # Keep proxies from buffering the stream
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        # Quart otherwise cuts the body off after RESPONSE_TIMEOUT (60s); the lock wait,
+        # retries and a long completion all happen while the stream is being sent
+        response.timeout = None
+        return response
 
     try:
-        client = get_azure_client()
-        completion = client.chat.completions.create(
-            model=session["model"],                 # Azure deployment name
-            messages=session["messages"],           # full history
-            temperature=float(temperature),
-            max_completion_tokens=int(max_completion_tokens),
-        )
-        response_text = ""
-        if completion.choices:
-            response_text = completion.choices[0].message.content or ""
-        if not response_text.strip():
+        async with turn_lock(token):
+            # Re-read under the lock so we build on any turn that just finished
+            session = await get_session(token)
+            if session is None:
+                return jsonify({"error": "Invalid session token"}), 401
+            pending = user_turn_messages(user_message, per_request_context)
+            messages = model_messages(session, pending, max_completion_tokens)
+            cache_key = response_cache_key(session["model"], messages, temperature, max_completion_tokens)
+
             try:
-                choice = completion.choices[0] if completion.choices else None
-                print("Empty model response", {
-                    "finish_reason": getattr(choice, "finish_reason", None),
-                    "has_tool_calls": bool(getattr(getattr(choice, "message", None), "tool_calls", None)),
-                    "usage": getattr(completion, "usage", None),
-                    "model": session.get("model"),
-                })
-            except Exception as log_error:
-                print("Empty model response (log failure)", repr(log_error))
-            response_text = "Sorry, I didn't receive a response from the model. Please try again."
+                cached = await redis_client.get(cache_key) if cache_key else None
+                if cached is not None:
+                    response_text = cached.decode()
+                else:
+                    completion = await call_azure(
+                        model=session["model"],                 # Azure deployment name
+                        messages=messages,
+                        temperature=temperature,
+                        max_completion_tokens=max_completion_tokens,
+                    )
+                    response_text = ""
+                    if completion.choices:
+                        response_text = completion.choices[0].message.content or ""
+                    if not response_text.strip():
+                        try:
+                            choice = completion.choices[0] if completion.choices else None
+                            logger.warning("Empty model response", extra={"fields": {
+                                "finish_reason": getattr(choice, "finish_reason", None),
+                                "has_tool_calls": bool(getattr(getattr(choice, "message", None), "tool_calls", None)),
+                                "usage": getattr(completion, "usage", None),
+                                "model": session.get("model"),
+                            }})
+                        except Exception:
+                            logger.exception("Empty model response (log failure)")
+                        response_text = EMPTY_RESPONSE_TEXT
+                    elif cache_key:
+                        await cache_response(cache_key, response_text)
 
-        # Append assistant reply to history
-        session["messages"].append({"role": "assistant", "content": response_text})
+                # Persist this turn (user message + assistant reply) to history
+                pending.append(chat_message("assistant", response_text))
+                await record_turn(token, session, pending)
 
-        return jsonify({"response": response_text})
-    except Exception as e:
-        # Log the exception in real apps (App Insights, etc.)
-        print("Azure OpenAI error:", repr(e))
-        return jsonify({"error": "Sorry, I encountered an error."}), 500
+                return jsonify({"response": response_text})
+            except Exception:
+                logger.exception("Azure OpenAI error")
+                return jsonify({"error": ERROR_RESPONSE_TEXT}), 500
+    except LockError:
+        return jsonify({"error": SESSION_BUSY_TEXT}), 409
+    except RedisError:
+        logger.exception("Session store error")
+        return jsonify({"error": ERROR_RESPONSE_TEXT}), 500
 
 @app.route("/api/reset", methods=["POST"])
-def reset_session():
+async def reset_session():
     """
-    Resets the conversation back to a single system message built from stored meta.
+    Resets the conversation back to the single system message composed at start.
     """
     token = extract_token(request.headers.get("Authorization"))
-    if not token or token not in user_sessions:
+    if not token:
         return jsonify({"error": "Invalid session token"}), 401
 
-    meta = user_sessions[token].get("meta", {})
-    system_prompt = build_system_prompt(meta.get("systemPrompt"), meta)
-    user_sessions[token]["messages"] = [{"role": "system", "content": system_prompt}]
+    try:
+        async with turn_lock(token):
+            local_sessions.pop(token, None)
+            if not await reset_messages(token):
+                return jsonify({"error": "Invalid session token"}), 401
+    except LockError:
+        return jsonify({"error": SESSION_BUSY_TEXT}), 409
+    except RedisError:
+        logger.exception("Session store error")
+        return jsonify({"error": ERROR_RESPONSE_TEXT}), 500
     return jsonify({"ok": True})
 
 # ------------------------------------------------------------------------------
@@ -0,0 +1,16 @@
+# Gunicorn picks this file up automatically from the working directory, so the
+# App Service default startup command (`gunicorn app:app`) serves the ASGI app.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# Each uvicorn worker runs an event loop (uvloop + httptools when installed)
+# and keeps many model calls in flight at once, so one worker per core is
+# enough; the sync-worker 2*cores+1 rule doesn't apply.
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Give in-flight requests and streams time to finish on restart
+graceful_timeout = 30
+keepalive = 75